@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import datetime as dt
+from typing import Dict, Any, List, Tuple
+import aiohttp
+from fake_telegram import start_fake_telegram
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ["get_user", "watch_ad", "withdraw", "verify_channel", "telegram_webhook"]
+ADMIN_TOKEN = "bench-admin"
+
+def seed_users(path: str, count: int):
+    # Written record by record so a 1M user store does not need to fit in memory twice
+    created_at = dt.datetime.now().isoformat()
+    with open(path, mode='w') as f:
+        f.write("{")
+        for user_id in range(1, count + 1):
+            user = {
+                "user_id": user_id,
+                "points": 1000000.0,
+                "monetag_daily_ads_watched": 0,
+                "monetag_zone1_daily_ads_watched": 0,
+                "monetag_zone2_daily_ads_watched": 0,
+                "monetag_zone3_daily_ads_watched": 0,
+                "last_ad_date": None,
+                "invited_friends": 0,
+                "easypaisa_jazzcash": None,
+                "invited_by": user_id // 10 or None,
+                "created_at": created_at,
+                "channel_verified": True,
+                "referral_earnings": 0.0
+            }
+            if user_id > 1:
+                f.write(",")
+            f.write(f'"{user_id}":{json.dumps(user)}')
+        f.write("}")
+
+def start_update(update_id: int, user_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+        }
+    }
+
+def build_request(endpoint: str, base_url: str, user_id: int, n: int) -> Tuple[str, str, Dict[str, Any]]:
+    if endpoint == "get_user":
+        return "GET", f"{base_url}/api/user/{user_id}", {}
+    if endpoint == "watch_ad":
+        return "POST", f"{base_url}/api/watch_ad/{user_id}", {}
+    if endpoint == "withdraw":
+        return "POST", f"{base_url}/api/withdraw/{user_id}", {"json": {"amount": 150, "easypaisa_jazzcash": "03000000000"}}
+    if endpoint == "verify_channel":
+        return "POST", f"{base_url}/api/verify_channel/{user_id}", {}
+    if endpoint == "telegram_webhook":
+        return "POST", f"{base_url}/telegram/webhook", {"json": start_update(n, user_id)}
+    raise ValueError(f"Unknown endpoint {endpoint}")
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def drive(session: aiohttp.ClientSession, endpoint: str, base_url: str, users: int, total: int, concurrency: int, seed: int) -> Dict[str, Any]:
+    # Drawn up front from a per-endpoint seed so every run sends the same requests regardless of scheduling
+    rng = random.Random(f"{seed}:{users}:{endpoint}")
+    user_ids = [rng.randint(1, users) for _ in range(total)]
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            method, url, kwargs = build_request(endpoint, base_url, user_ids[n], n)
+            started = time.perf_counter()
+            try:
+                async with session.request(method, url, **kwargs) as resp:
+                    await resp.read()
+                    if resp.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "endpoint": endpoint,
+        "requests": total,
+        "concurrency": concurrency,
+        "seed": seed,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0
+    }
+
+async def wait_until_ready(session: aiohttp.ClientSession, base_url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            async with session.get(f"{base_url}/api/user/1") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("Server did not become ready in time")
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def run_size(args, users: int) -> List[Dict[str, Any]]:
+    # The seeded store, its shards and the app's other files can reach gigabytes at 1M users
+    workdir = tempfile.mkdtemp(prefix=f"bench-{users}-")
+    try:
+        return await run_size_in(args, users, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def run_size_in(args, users: int, workdir: str) -> List[Dict[str, Any]]:
+    users_file = os.path.join(workdir, "users.json")
+    seed_started = time.perf_counter()
+    seed_users(users_file, users)
+    print(f"Seeded {users} users in {time.perf_counter() - seed_started:.1f}s ({os.path.getsize(users_file)} bytes)")
+
+    fake, runner = await start_fake_telegram(args.telegram_port, args.telegram_latency)
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:bench",
+        PORT=str(args.port),
+        USERS_FILE=users_file,
+        WITHDRAWALS_FILE=os.path.join(workdir, "withdrawals.jsonl"),
+        AD_EVENTS_DIR=os.path.join(workdir, "ad_events"),
+        BROADCAST_FILE=os.path.join(workdir, "broadcast.json"),
+        TELEGRAM_API_URL=f"http://127.0.0.1:{args.telegram_port}",
+        ADMIN_TOKEN=ADMIN_TOKEN,
+        ADMIN_CHANNEL_ID="-100",
+        RATE_LIMIT_USER_RATE="1000000",
+        RATE_LIMIT_USER_BURST="1000000",
+        RATE_LIMIT_IP_RATE="1000000",
+        RATE_LIMIT_IP_BURST="1000000"
+    )
+    env.pop("BASE_URL", None)
+    base_url = f"http://127.0.0.1:{args.port}"
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=REPO_DIR, env=env)
+    results = []
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            startup_started = time.perf_counter()
+            await wait_until_ready(session, base_url, process, args.startup_timeout)
+            print(f"Server ready in {time.perf_counter() - startup_started:.2f}s")
+            for endpoint in args.endpoints:
+                result = await drive(session, endpoint, base_url, users, args.requests, args.concurrency, args.seed)
+                result.update(users=users, commit=git_commit(), timestamp=dt.datetime.now().isoformat())
+                results.append(result)
+                print(
+                    f"{users:>9} {endpoint:<18} p50 {result['p50_ms']:>9.2f}ms  p99 {result['p99_ms']:>9.2f}ms  "
+                    f"{result['throughput_rps']:>8.1f} req/s  errors {result['errors']}"
+                )
+        print(f"Fake Telegram calls: {fake.calls}")
+    finally:
+        process.terminate()
+        process.wait()
+        await runner.cleanup()
+    return results
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load-test the bot API against a fake Telegram server")
+    parser.add_argument("--users", default="1000,100000,1000000", help="Comma separated store sizes")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="Comma separated subset of " + ",".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the request sequence, keep fixed when comparing commits")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--telegram-port", type=int, default=8766)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Seconds added to every fake Telegram call")
+    parser.add_argument("--startup-timeout", type=float, default=600.0)
+    parser.add_argument("--output", default=os.path.join(REPO_DIR, "bench_output.txt"), help="JSON lines file results are appended to")
+    args = parser.parse_args()
+    args.endpoints = [endpoint for endpoint in args.endpoints.split(",") if endpoint]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+    for users in (int(size) for size in args.users.split(",")):
+        results = await run_size(args, users)
+        with open(args.output, mode='a') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    print(f"Results appended to {args.output}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,20 +1,35 @@
+from __future__ import annotations
+
 import os
+import io
+import re
+import sys
+import csv
 import json
+import functools
 import aiofiles
 import aiohttp
 import threading
 import datetime as dt
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, AsyncIterator, List, TYPE_CHECKING
 import logging
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-from telegram.ext import Application, CommandHandler, ContextTypes
+import time
+import bisect
+import traceback
+from collections import OrderedDict
+from itertools import islice
+from contextlib import asynccontextmanager
+from importlib import import_module
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 import uvicorn
-import requests
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+
 load_dotenv()
 
 # Config
@@ -29,48 +44,408 @@ MONETAG_ZONE = "9859391"
 MONETAG_ZONE1 = "9930174"
 MONETAG_ZONE2 = "9930913"
 MONETAG_ZONE3 = "9930950"
-USERS_FILE = "/tmp/users.json"
+USERS_FILE = os.getenv("USERS_FILE", "/tmp/users.json")
+WITHDRAWALS_FILE = os.getenv("WITHDRAWALS_FILE", "/tmp/withdrawals.jsonl")
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "/tmp/broadcast.json")
+AD_EVENTS_DIR = os.getenv("AD_EVENTS_DIR", "/tmp/ad_events")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "1"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "5"))
+RATE_LIMIT_IP_RATE = float(os.getenv("RATE_LIMIT_IP_RATE", "5"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "20"))
+RATE_LIMIT_TTL = 300
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+# Proxies in front of the app that append to X-Forwarded-For; Heroku's router is one hop
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+EXPORT_CHUNK_SIZE = 500
+AD_ZONE_KEYS = ["monetag", "monetag_zone1", "monetag_zone2", "monetag_zone3"]
+AD_REWARD = 0.5
+REFERRAL_BONUS = 0.035
+AD_EVENT_FLUSH_INTERVAL = 1.0
+ROLLUP_INTERVAL = 300
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = 10
+BROADCAST_CHUNK = 100
+LEADERBOARD_SIZE = 100
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+PROFILE_MAX_SECONDS = 60
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "30"))
+BOT_INIT_MAX_BACKOFF = 60
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_MS", "10")) / 1000
+USER_SHARDS = int(os.getenv("USER_SHARDS", "16"))
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
-json_lock = asyncio.Lock()
+background_tasks = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    # Keep a reference so the task is not garbage collected while running
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.series: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in self.series.items()]
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, getter=None):
+        self.name = name
+        self.description = description
+        self.getter = getter
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def samples(self) -> List[str]:
+        value = self.getter() if self.getter else self.value
+        return [f"{self.name} {value}"]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # Per label set: [per-bucket counts..., sum, count]
+        self.series: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in self.series.items():
+            for bound, count in zip(self.buckets, series):
+                bucket_labels = format_labels(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            inf_labels = format_labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series[-1]}")
+        return lines
+
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route")
+store_lock_wait = Histogram("store_lock_wait_seconds", "Time spent waiting for the user store lock")
+store_duration = Histogram("store_operation_duration_seconds", "User store read/write duration")
+store_bytes = Counter("store_bytes_total", "Bytes read from and written to the user store")
+telegram_api_duration = Histogram("telegram_api_duration_seconds", "Outbound Telegram Bot API latency")
+telegram_api_errors = Counter("telegram_api_errors_total", "Failed outbound Telegram Bot API calls")
+webhook_in_flight = Gauge("webhook_updates_in_flight", "Telegram updates currently being processed")
+users_total = Gauge("users_total", "Users in the loaded store shards", lambda: sum(len(shard.data or ()) for shard in users_shards))
+pending_withdrawals_total = Gauge("withdrawals_pending", "Withdrawals waiting for payout", lambda: len(pending_withdrawals))
+METRICS = [
+    http_request_duration, store_lock_wait, store_duration, store_bytes, telegram_api_duration,
+    telegram_api_errors, webhook_in_flight, users_total, pending_withdrawals_total
+]
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+def timed(op: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                store_duration.observe(time.perf_counter() - started, op=op)
+        return wrapper
+    return decorator
+
+@asynccontextmanager
+async def store_lock(lock: asyncio.Lock, op: str):
+    started = time.perf_counter()
+    async with lock:
+        store_lock_wait.observe(time.perf_counter() - started, op=op)
+        yield
+
+@asynccontextmanager
+async def observe_telegram(method: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        telegram_api_errors.inc(method=method)
+        raise
+    finally:
+        telegram_api_duration.observe(time.perf_counter() - started, method=method)
+
+def instrumented_request():
+    from telegram.request import HTTPXRequest
+
+    class InstrumentedRequest(HTTPXRequest):
+        async def do_request(self, url: str, method: str, *args, **kwargs):
+            api_method = url.rsplit("/", 1)[-1]
+            async with observe_telegram(api_method):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+            if code >= 400:
+                telegram_api_errors.inc(method=api_method)
+            return code, payload
+
+    # Match the pool size ApplicationBuilder uses by default; HTTPXRequest alone defaults to one connection
+    return InstrumentedRequest(connection_pool_size=256)
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                route=route.path if route is not None else "unmatched",
+                method=scope["method"],
+                status=str(status)
+            )
 
 # JSON utils
-async def read_json() -> Dict[str, Any]:
-    async with json_lock:
+def write_snapshot(path: str, content: str):
+    # Write beside the target and rename over it so readers and crashes never see a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode='w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def parse_snapshot(content: str) -> Dict[str, Any]:
+    return json.loads(content) if content.strip() else {}
+
+def encode_record(key: str, record: Dict[str, Any]) -> str:
+    return f'{json.dumps(key)}:{json.dumps(record, separators=(",", ":"))}'
+
+def encode_records(data: Dict[str, Any]) -> Dict[str, str]:
+    return {key: encode_record(key, record) for key, record in data.items()}
+
+def write_records(path: str, records: List[str]) -> int:
+    content = "{" + ",".join(records) + "}"
+    write_snapshot(path, content)
+    return len(content)
+
+class SnapshotStore:
+    # Users live in memory once loaded; commits within GROUP_COMMIT_WINDOW share one snapshot write and fsync.
+    # Each record is kept encoded and only re-encoded when committed, so the loop never serializes a whole shard.
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = asyncio.Lock()
+        self.data: Optional[Dict[str, Any]] = None
+        self.records: Dict[str, str] = {}
+        self.dirty: set = set()
+        self.pending: Optional[asyncio.Future] = None
+
+    async def load(self) -> Dict[str, Any]:
+        if self.data is None:
+            async with store_lock(self.lock, "read"):
+                if self.data is None:
+                    await self.replace(await self.read_file())
+        return self.data
+
+    async def replace(self, data: Dict[str, Any]):
+        # Encoded off the loop before the data is published, so no handler can change it meanwhile
+        self.records = await asyncio.to_thread(encode_records, data)
+        self.dirty.clear()
+        self.data = data
+
+    async def read_file(self) -> Dict[str, Any]:
         try:
-            async with aiofiles.open(USERS_FILE, mode='r') as f:
+            async with aiofiles.open(self.path, mode='r') as f:
                 content = await f.read()
-                if content.strip():
-                    return json.loads(content)
-                return {}
         except FileNotFoundError:
             return {}
+        store_bytes.inc(len(content), op="read")
+        try:
+            return await asyncio.to_thread(parse_snapshot, content)
         except Exception as e:
-            logger.error(f"Error reading {USERS_FILE}: {e}")
+            logger.error(f"Error reading {self.path}: {e}")
             raise
 
-async def write_json(users: Dict[str, Any]):
-    async with json_lock:
-        async with aiofiles.open(USERS_FILE, mode='w') as f:
-            await f.write(json.dumps(users, indent=2))
+    async def commit(self, data: Dict[str, Any], keys: List[str]):
+        self.data = data
+        self.dirty.update(keys)
+        if self.pending is None:
+            self.pending = asyncio.get_running_loop().create_future()
+            spawn_background(self.flush())
+        await asyncio.shield(self.pending)
+
+    async def flush(self):
+        await asyncio.sleep(GROUP_COMMIT_WINDOW)
+        async with store_lock(self.lock, "write"):
+            # Commits arriving from here on join the next group
+            waiters, self.pending = self.pending, None
+            started = time.perf_counter()
+            try:
+                for key in self.dirty:
+                    record = self.data.get(key)
+                    if record is None:
+                        self.records.pop(key, None)
+                    else:
+                        self.records[key] = encode_record(key, record)
+                self.dirty.clear()
+                written = await asyncio.to_thread(write_records, self.path, list(self.records.values()))
+            except Exception as e:
+                logger.error(f"Error writing {self.path}: {e}")
+                waiters.set_exception(e)
+                waiters.exception()
+                return
+            store_duration.observe(time.perf_counter() - started, op="flush")
+            store_bytes.inc(written, op="write")
+            waiters.set_result(None)
+
+    async def wait_flushed(self):
+        if self.pending is not None:
+            await asyncio.shield(self.pending)
+
+def shard_path(index: int) -> str:
+    root, ext = os.path.splitext(USERS_FILE)
+    return f"{root}.{index:03d}{ext or '.json'}"
+
+def manifest_path() -> str:
+    root, _ = os.path.splitext(USERS_FILE)
+    return f"{root}.manifest.json"
+
+# Users are partitioned by user_id so a write only serializes and fsyncs one shard
+users_shards = [SnapshotStore(shard_path(i)) for i in range(USER_SHARDS)]
+
+def shard_for(user_id: int) -> SnapshotStore:
+    return users_shards[int(user_id) % USER_SHARDS]
+
+@timed("read")
+async def read_json(user_id: int) -> Dict[str, Any]:
+    return await shard_for(user_id).load()
+
+@timed("write")
+async def write_json(user_id: int, users: Dict[str, Any]):
+    await shard_for(user_id).commit(users, [str(user_id)])
+
+def partition_users(users: Dict[str, Any]) -> List[Dict[str, Any]]:
+    parts: List[Dict[str, Any]] = [{} for _ in range(USER_SHARDS)]
+    for user_id_str, user in users.items():
+        parts[int(user_id_str) % USER_SHARDS][user_id_str] = user
+    return parts
+
+async def migrate_users_file():
+    # Splits a pre-sharding users.json into shard files. Renaming users.json is the commit point,
+    # so an interrupted run is redone from scratch and overwrites any partial shard files.
+    legacy = SnapshotStore(USERS_FILE)
+    users = await legacy.read_file()
+    parts = await asyncio.to_thread(partition_users, users)
+    for shard, part in zip(users_shards, parts):
+        await shard.replace(part)
+    await asyncio.gather(*(shard.commit(shard.data, []) for shard in users_shards))
+    os.replace(USERS_FILE, f"{USERS_FILE}.migrated")
+    logger.info(f"Migrated {len(users)} users from {USERS_FILE} into {USER_SHARDS} shards")
+
+def existing_shard_indexes() -> List[int]:
+    root, ext = os.path.splitext(USERS_FILE)
+    directory = os.path.dirname(root) or "."
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.(\d{3})" + re.escape(ext or ".json") + "$")
+    return [int(match.group(1)) for match in map(pattern.match, os.listdir(directory)) if match]
+
+def check_shard_manifest():
+    # Users are placed by user_id % USER_SHARDS, so changing the count would silently misroute them
+    path = manifest_path()
+    try:
+        with open(path) as f:
+            shards = json.load(f)["shards"]
+    except FileNotFoundError:
+        shards = None
+    if shards is not None and shards != USER_SHARDS:
+        raise RuntimeError(f"{path} records {shards} shards but USER_SHARDS is {USER_SHARDS}; reshard the store before changing it")
+    stray = [index for index in existing_shard_indexes() if index >= USER_SHARDS]
+    if stray:
+        raise RuntimeError(f"Found shard files up to index {max(stray)} but USER_SHARDS is {USER_SHARDS}")
+    if shards is None:
+        write_snapshot(path, json.dumps({"shards": USER_SHARDS}))
 
 async def init_json():
     try:
-        async with aiofiles.open(USERS_FILE, mode='a') as f:
-            pass
-        users = await read_json()
-        if not users:
-            await write_json({})
+        check_shard_manifest()
+        if os.path.exists(USERS_FILE):
+            await migrate_users_file()
+        # One shard at a time: parsing threads contend for the GIL, so running them together only starves the loop
+        for shard in users_shards:
+            await shard.load()
     except Exception as e:
         logger.error(f"JSON init failed: {e}")
         raise
 
+@app.on_event("shutdown")
+async def flush_json():
+    await asyncio.gather(*(shard.wait_flushed() for shard in users_shards))
+
 async def get_or_create_user(user_id: int, invited_by: Optional[int] = None) -> Tuple[dict, bool]:
-    users = await read_json()
+    users = await read_json(user_id)
     user_id_str = str(user_id)
     is_new = user_id_str not in users
     if is_new:
@@ -86,30 +461,33 @@ async def get_or_create_user(user_id: int, invited_by: Optional[int] = None) ->
             "easypaisa_jazzcash": None,
             "invited_by": invited_by,
             "created_at": dt.datetime.now().isoformat(),
-            "channel_verified": False
+            "channel_verified": False,
+            "referral_earnings": 0.0
         }
-        await write_json(users)
+        await write_json(user_id, users)
+        if invited_by and invited_by != user_id:
+            index_referral(invited_by, user_id)
     return users[user_id_str], is_new
 
 async def get_user_data(user_id: int) -> dict:
-    users = await read_json()
+    users = await read_json(user_id)
     user_id_str = str(user_id)
     if user_id_str in users:
         return users[user_id_str]
     raise ValueError(f"User {user_id} not found")
 
 async def update_points(user_id: int, points: float):
-    users = await read_json()
+    users = await read_json(user_id)
     user_id_str = str(user_id)
     if user_id_str in users:
         users[user_id_str]["points"] += points
-        await write_json(users)
+        await write_json(user_id, users)
     else:
         logger.error(f"Cannot update points: user {user_id} not found")
 
 async def update_daily_ads(user_id: int, platform: str, ads_watched: int):
     today = dt.datetime.now().date().isoformat()
-    users = await read_json()
+    users = await read_json(user_id)
     user_id_str = str(user_id)
     if user_id_str in users:
         user_data = users[user_id_str]
@@ -122,55 +500,745 @@ async def update_daily_ads(user_id: int, platform: str, ads_watched: int):
             user_data["monetag_zone3_daily_ads_watched"] = 0
             user_data[f"{platform}_daily_ads_watched"] = ads_watched
             user_data["last_ad_date"] = today
-        await write_json(users)
+        await write_json(user_id, users)
     else:
         logger.error(f"Cannot update {platform} ads: user {user_id} not found")
 
+async def add_referral_earning(referrer_id: int, amount: float) -> float:
+    users = await read_json(referrer_id)
+    referrer_id_str = str(referrer_id)
+    if referrer_id_str in users:
+        referrer = users[referrer_id_str]
+        referrer["points"] += amount
+        referrer["referral_earnings"] = referrer.get("referral_earnings", 0.0) + amount
+        await write_json(referrer_id, users)
+        index_referral_earning(referrer_id, referrer["referral_earnings"])
+        return amount
+    logger.error(f"Cannot add referral earning: user {referrer_id} not found")
+    return 0.0
+
 async def add_invited_friend(user_id: int):
-    users = await read_json()
+    users = await read_json(user_id)
     user_id_str = str(user_id)
     if user_id_str in users:
         users[user_id_str]["invited_friends"] += 1
-        await write_json(users)
+        await write_json(user_id, users)
     else:
         logger.error(f"Cannot add friend: user {user_id} not found")
 
 async def withdraw_points(user_id: int, amount: float, easypaisa_jazzcash: str) -> bool:
-    users = await read_json()
-    user_id_str = str(user_id)
-    if user_id_str in users and users[user_id_str]["points"] >= amount:
-        users[user_id_str]["points"] -= amount
-        users[user_id_str]["easypaisa_jazzcash"] = easypaisa_jazzcash
-        await write_json(users)
-        await application.bot.send_message(
+    withdrawal = await create_withdrawal(user_id, amount, easypaisa_jazzcash)
+    if withdrawal is None:
+        return False
+    try:
+        await get_application().bot.send_message(
             chat_id=ADMIN_CHANNEL_ID,
-            text=f"Withdrawal Request:\nUser ID: {user_id}\nAmount: {amount} RS\nEasypaisa/Jazzcash: {easypaisa_jazzcash}"
+            text=f"Withdrawal Request #{withdrawal['id']}:\nUser ID: {user_id}\nAmount: {amount} RS\nEasypaisa/Jazzcash: {easypaisa_jazzcash}"
         )
-        return True
-    return False
+    except Exception as e:
+        # The withdrawal is already committed and listed by /admin/withdrawals/pending; failing here would
+        # let a retry with the same idempotency key create and debit it again
+        logger.error(f"Failed to notify admin channel of withdrawal #{withdrawal['id']}: {e}")
+    return True
+
+# Withdrawal ledger
+WITHDRAWAL_STATES = ("pending", "paid", "rejected")
+ledger_lock = asyncio.Lock()
+withdrawals: Dict[int, dict] = {}
+pending_withdrawals: "OrderedDict[int, dict]" = OrderedDict()
+next_withdrawal_id = 1
+ledger_seq = 0
+# user_id -> [(seq, points delta, account)] for every balance change recorded in the ledger
+balance_changes: Dict[int, List[Tuple[int, float, Optional[str]]]] = {}
+
+def append_ledger_lines(lines: List[str]):
+    with open(WITHDRAWALS_FILE, mode='a') as f:
+        f.write("".join(line + "\n" for line in lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+def apply_ledger_entry(entry: Dict[str, Any]):
+    global next_withdrawal_id, ledger_seq
+    ledger_seq = max(ledger_seq, entry["seq"])
+    if entry["op"] == "create":
+        withdrawal = {
+            "id": entry["id"],
+            "user_id": entry["user_id"],
+            "amount": entry["amount"],
+            "account": entry["account"],
+            "state": "pending",
+            "created_at": entry["at"],
+            "processed_at": None
+        }
+        withdrawals[withdrawal["id"]] = withdrawal
+        pending_withdrawals[withdrawal["id"]] = withdrawal
+        next_withdrawal_id = max(next_withdrawal_id, withdrawal["id"] + 1)
+        balance_changes.setdefault(entry["user_id"], []).append((entry["seq"], -entry["amount"], entry["account"]))
+    elif entry["op"] == "batch":
+        for withdrawal_id in entry["ids"]:
+            withdrawal = pending_withdrawals.pop(withdrawal_id, None)
+            if withdrawal is not None:
+                withdrawal["state"] = entry["state"]
+                withdrawal["processed_at"] = entry["at"]
+                if entry["state"] == "rejected":
+                    balance_changes.setdefault(withdrawal["user_id"], []).append((entry["seq"], withdrawal["amount"], None))
+
+async def load_withdrawal_ledger():
+    withdrawals.clear()
+    pending_withdrawals.clear()
+    balance_changes.clear()
+    try:
+        async with aiofiles.open(WITHDRAWALS_FILE, mode='r') as f:
+            async for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    apply_ledger_entry(json.loads(line))
+                except (ValueError, KeyError) as e:
+                    # A torn trailing line from a crash mid-append is dropped
+                    logger.error(f"Skipping bad ledger line in {WITHDRAWALS_FILE}: {e}")
+    except FileNotFoundError:
+        pass
+    logger.info(f"Withdrawal ledger loaded: {len(withdrawals)} total, {len(pending_withdrawals)} pending")
+
+def apply_balance_changes(user: dict, changes: List[Tuple[int, float, Optional[str]]]) -> bool:
+    # The ledger is authoritative; a user's ledger_seq is the last entry its balance reflects, so replays are idempotent
+    applied = user.get("ledger_seq", 0)
+    changed = False
+    for seq, delta, account in changes:
+        if seq > applied:
+            user["points"] += delta
+            if account is not None:
+                user["easypaisa_jazzcash"] = account
+            user["ledger_seq"] = seq
+            changed = True
+    return changed
+
+async def apply_ledger_to_users(user_ids: List[int]):
+    touched: Dict[int, Dict[str, Any]] = {}
+    for user_id in dict.fromkeys(user_ids):
+        users = await read_json(user_id)
+        user = users.get(str(user_id))
+        if user is not None and apply_balance_changes(user, balance_changes.get(user_id, [])):
+            touched[user_id] = users
+    # Commits to the same shard share one group write
+    await asyncio.gather(*(write_json(user_id, users) for user_id, users in touched.items()))
+
+async def reconcile_withdrawals():
+    # Re-applies debits and refunds whose store write was lost after the ledger line was written
+    await apply_ledger_to_users(list(balance_changes))
+
+async def append_ledger_entry(entry: Dict[str, Any]):
+    entry["seq"] = ledger_seq + 1
+    await asyncio.to_thread(append_ledger_lines, [json.dumps(entry)])
+    apply_ledger_entry(entry)
+
+async def create_withdrawal(user_id: int, amount: float, account: str) -> Optional[dict]:
+    async with ledger_lock:
+        users = await read_json(user_id)
+        user = users.get(str(user_id))
+        if user is None or user["points"] < amount:
+            return None
+        entry = {
+            "op": "create",
+            "id": next_withdrawal_id,
+            "user_id": user_id,
+            "amount": amount,
+            "account": account,
+            "at": dt.datetime.now().isoformat()
+        }
+        # The ledger line is the commit point; the debit below is replayed from it if it is lost
+        await append_ledger_entry(entry)
+        await apply_ledger_to_users([user_id])
+        return withdrawals[entry["id"]]
+
+async def process_withdrawals(state: str, withdrawal_ids: List[int]) -> List[dict]:
+    async with ledger_lock:
+        batch = [pending_withdrawals[i] for i in dict.fromkeys(withdrawal_ids) if i in pending_withdrawals]
+        if not batch:
+            return []
+        await append_ledger_entry({"op": "batch", "state": state, "ids": [w["id"] for w in batch], "at": dt.datetime.now().isoformat()})
+        if state == "rejected":
+            # Rejected payouts are refunded with one write per touched shard
+            await apply_ledger_to_users([w["user_id"] for w in batch])
+        return batch
+
+# Referral index
+class TopK:
+    # Exact only while scores never decrease, which holds for referral counts and earnings
+    def __init__(self, k: int):
+        self.k = k
+        self.entries: Dict[int, float] = {}
+
+    def update(self, key: int, score: float):
+        if key in self.entries or len(self.entries) < self.k:
+            self.entries[key] = score
+            return
+        lowest = min(self.entries, key=self.entries.__getitem__)
+        if score > self.entries[lowest]:
+            del self.entries[lowest]
+            self.entries[key] = score
+
+    def top(self, n: int) -> List[Tuple[int, float]]:
+        return sorted(self.entries.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def clear(self):
+        self.entries.clear()
+
+referral_children: Dict[int, set] = {}
+referral_earnings: Dict[int, float] = {}
+top_inviters = TopK(LEADERBOARD_SIZE)
+top_earners = TopK(LEADERBOARD_SIZE)
+
+def index_referral(referrer_id: int, user_id: int):
+    children = referral_children.setdefault(referrer_id, set())
+    children.add(user_id)
+    top_inviters.update(referrer_id, len(children))
+
+def index_referral_earning(referrer_id: int, total: float):
+    referral_earnings[referrer_id] = total
+    top_earners.update(referrer_id, total)
+
+async def build_referral_index():
+    referral_children.clear()
+    referral_earnings.clear()
+    top_inviters.clear()
+    top_earners.clear()
+    async for chunk in iter_users():
+        for _, user in chunk:
+            invited_by = user.get("invited_by")
+            if invited_by and invited_by != user["user_id"]:
+                index_referral(invited_by, user["user_id"])
+            if user.get("referral_earnings"):
+                index_referral_earning(user["user_id"], user["referral_earnings"])
+    logger.info(f"Referral index built: {len(referral_children)} referrers")
+
+def referral_levels(user_id: int, depth: int) -> List[int]:
+    levels = []
+    frontier = [user_id]
+    seen = {user_id}
+    for _ in range(depth):
+        next_frontier = []
+        for parent_id in frontier:
+            for child_id in referral_children.get(parent_id, ()):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    next_frontier.append(child_id)
+        if not next_frontier:
+            break
+        levels.append(len(next_frontier))
+        frontier = next_frontier
+    return levels
+
+async def iter_users(chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[List[Tuple[str, dict]]]:
+    for shard in users_shards:
+        users = await shard.load()
+        user_ids = list(users)
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = []
+            for user_id_str in user_ids[start:start + chunk_size]:
+                user = users.get(user_id_str)
+                if user is not None:
+                    chunk.append((user_id_str, user))
+            yield chunk
+            # Let request handlers run between chunks
+            await asyncio.sleep(0)
 
 async def verify_channel_membership(user_id: int) -> bool:
     try:
         async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/getChatMember",
-                json={"chat_id": PUBLIC_CHANNEL_USERNAME, "user_id": user_id}
-            ) as resp:
-                if resp.status == 200:
+            async with observe_telegram("getChatMember"):
+                async with session.post(
+                    f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getChatMember",
+                    json={"chat_id": PUBLIC_CHANNEL_USERNAME, "user_id": user_id}
+                ) as resp:
+                    if resp.status != 200:
+                        telegram_api_errors.inc(method="getChatMember")
+                        return False
                     data = await resp.json()
-                    if data.get("ok") and data.get("result").get("status") in ["member", "administrator", "creator"]:
-                        users = await read_json()
-                        user_id_str = str(user_id)
-                        if user_id_str in users:
-                            users[user_id_str]["channel_verified"] = True
-                            await write_json(users)
-                        return True
-                    return False
-                return False
+        if data.get("ok") and data.get("result").get("status") in ["member", "administrator", "creator"]:
+            users = await read_json(user_id)
+            user_id_str = str(user_id)
+            if user_id_str in users:
+                users[user_id_str]["channel_verified"] = True
+                await write_json(user_id, users)
+            return True
+        return False
     except Exception as e:
         logger.error(f"Error verifying channel membership for {user_id}: {e}")
         return False
 
+# Ad view events
+# One line per view in AD_EVENTS_DIR/<date>.log: unix_ts,user_id,zone_key,reward,referrer_id,referral_bonus
+ad_event_buffer: Dict[str, List[str]] = {}
+rollup_lock = asyncio.Lock()
+ROLLUP_FILE = os.path.join(AD_EVENTS_DIR, "rollup.json")
+
+def record_ad_view(user_id: int, zone_key: str, invited_by: Optional[int], referral_bonus: float):
+    now = dt.datetime.now()
+    line = f"{int(now.timestamp())},{user_id},{zone_key},{AD_REWARD},{invited_by or ''},{referral_bonus}\n"
+    ad_event_buffer.setdefault(now.date().isoformat(), []).append(line)
+
+def append_ad_events(day: str, lines: List[str]):
+    os.makedirs(AD_EVENTS_DIR, exist_ok=True)
+    with open(os.path.join(AD_EVENTS_DIR, f"{day}.log"), mode='a') as f:
+        f.write("".join(lines))
+
+async def flush_ad_events():
+    global ad_event_buffer
+    if not ad_event_buffer:
+        return
+    batches, ad_event_buffer = ad_event_buffer, {}
+    days = list(batches)
+    for i, day in enumerate(days):
+        try:
+            await asyncio.to_thread(append_ad_events, day, batches[day])
+        except Exception:
+            # Put unwritten days back ahead of events recorded meanwhile so the next flush retries them
+            for pending_day in days[i:]:
+                ad_event_buffer[pending_day] = batches[pending_day] + ad_event_buffer.get(pending_day, [])
+            raise
+
+async def flush_ad_events_periodically():
+    while True:
+        await asyncio.sleep(AD_EVENT_FLUSH_INTERVAL)
+        try:
+            await flush_ad_events()
+        except Exception as e:
+            logger.error(f"Error flushing ad events: {e}")
+
+def roll_up_ad_events() -> Dict[str, Any]:
+    # Folds only the bytes appended since the last run into per-day, per-zone totals
+    try:
+        with open(ROLLUP_FILE) as f:
+            rollup = json.load(f)
+    except FileNotFoundError:
+        rollup = {"offsets": {}, "days": {}}
+    if not os.path.isdir(AD_EVENTS_DIR):
+        return rollup
+    changed = False
+    for name in sorted(os.listdir(AD_EVENTS_DIR)):
+        if not name.endswith(".log"):
+            continue
+        day = name[:-len(".log")]
+        offset = rollup["offsets"].get(day, 0)
+        with open(os.path.join(AD_EVENTS_DIR, name), mode='rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # Leave a partially written last line for the next run
+        end = data.rfind(b"\n") + 1
+        if not end:
+            continue
+        zones = rollup["days"].setdefault(day, {})
+        for line in data[:end].decode().splitlines():
+            try:
+                _, _, zone_key, reward, _, bonus = line.split(",")
+                reward, bonus = float(reward), float(bonus)
+            except ValueError:
+                logger.error(f"Skipping bad ad event line in {name}: {line!r}")
+                continue
+            totals = zones.setdefault(zone_key, {"views": 0, "rewards": 0.0, "referral_bonuses": 0.0})
+            totals["views"] += 1
+            totals["rewards"] += reward
+            totals["referral_bonuses"] += bonus
+        rollup["offsets"][day] = offset + end
+        changed = True
+    if changed:
+        write_snapshot(ROLLUP_FILE, json.dumps(rollup))
+    return rollup
+
+async def run_ad_rollup() -> Dict[str, Any]:
+    await flush_ad_events()
+    async with rollup_lock:
+        return await asyncio.to_thread(roll_up_ad_events)
+
+async def roll_up_ad_events_periodically():
+    while True:
+        await asyncio.sleep(ROLLUP_INTERVAL)
+        try:
+            await run_ad_rollup()
+        except Exception as e:
+            logger.error(f"Error rolling up ad events: {e}")
+
+@app.on_event("shutdown")
+async def flush_ad_events_on_shutdown():
+    await flush_ad_events()
+
+# Idempotency
+idempotency_cache: "OrderedDict[str, Any]" = OrderedDict()
+idempotency_inflight: Dict[str, asyncio.Future] = {}
+
+def idempotency_key(request: Request, scope: str, user_id: int) -> Optional[str]:
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return None
+    return f"{scope}:{user_id}:{key[:128]}"
+
+async def run_idempotent(key: Optional[str], handler) -> Any:
+    if key is None:
+        return await handler()
+    if key in idempotency_cache:
+        idempotency_cache.move_to_end(key)
+        return idempotency_cache[key]
+    inflight = idempotency_inflight.get(key)
+    if inflight is not None:
+        # A retry of a request that is still running: wait for its result instead of mutating again
+        return await asyncio.shield(inflight)
+
+    future = asyncio.get_running_loop().create_future()
+    idempotency_inflight[key] = future
+    try:
+        result = await handler()
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            # Duplicates must not hang on a request that will never finish; let them retry instead
+            future.set_exception(HTTPException(status_code=503, detail="Request interrupted, retry"))
+        else:
+            future.set_exception(e)
+        future.exception()  # mark retrieved so unobserved failures don't warn
+        raise
+    finally:
+        idempotency_inflight.pop(key, None)
+    idempotency_cache[key] = result
+    if len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+        idempotency_cache.popitem(last=False)
+    future.set_result(result)
+    return result
+
+# Readiness
+store_ready = asyncio.Event()
+bot_ready = asyncio.Event()
+startup_error: Optional[str] = None
+# First matching prefix wins; routes that call the bot also wait for it so telegram is never imported on the loop,
+# and bot updates wait for the store because /start creates and updates users
+READY_GATES = [
+    ("/api/withdraw/", (store_ready, bot_ready)),
+    ("/api/", (store_ready,)),
+    ("/admin/withdrawals/process", (store_ready, bot_ready)),
+    ("/admin/broadcast", (store_ready, bot_ready)),
+    ("/admin/", (store_ready,)),
+    ("/telegram/", (store_ready, bot_ready)),
+    ("/set-webhook", (bot_ready,))
+]
+
+class ReadinessMiddleware:
+    # Lets the port bind immediately while startup finishes in the background
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for prefix, events in READY_GATES:
+                if scope["path"].startswith(prefix):
+                    if not await wait_ready(events):
+                        response = JSONResponse(
+                            {"success": False, "message": "Service starting, try again shortly"},
+                            status_code=503,
+                            headers={"Retry-After": "1"}
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+async def wait_ready(events: Tuple[asyncio.Event, ...]) -> bool:
+    pending = [event.wait() for event in events if not event.is_set()]
+    if not pending:
+        return True
+    try:
+        await asyncio.wait_for(asyncio.gather(*pending), READY_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+app.add_middleware(ReadinessMiddleware)
+
+@app.get("/healthz")
+async def healthz():
+    return {"ok": True}
+
+@app.get("/readyz")
+async def readyz():
+    ready = store_ready.is_set() and bot_ready.is_set()
+    return JSONResponse(
+        {"ready": ready, "store": store_ready.is_set(), "bot": bot_ready.is_set(), "error": startup_error},
+        status_code=200 if ready else 503
+    )
+
+# Rate limiting
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+class TokenBucketTable:
+    # Buckets are kept in last-use order so idle and least recently used ones are evicted from the front in O(1)
+    def __init__(self, rate: float, burst: float, ttl: float = RATE_LIMIT_TTL, max_size: int = RATE_LIMIT_MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.ttl = ttl
+        self.max_size = max_size
+        self.buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def acquire(self, key: str, now: float, cost: float = 1.0) -> float:
+        # Returns 0 when allowed, otherwise the seconds until enough tokens are available
+        self.evict(now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self.buckets.move_to_end(key)
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            return 0.0
+        return (cost - bucket.tokens) / self.rate
+
+    def evict(self, now: float):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if now - bucket.updated < self.ttl:
+                break
+            del self.buckets[key]
+
+user_buckets = TokenBucketTable(RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST)
+ip_buckets = TokenBucketTable(RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST)
+
+def client_ip(scope: Dict[str, Any]) -> str:
+    # Entries left of the trusted hops are supplied by the client and can be forged
+    if TRUSTED_PROXY_HOPS > 0:
+        forwarded = [
+            value.decode("latin-1") for name, value in scope.get("headers", [])
+            if name == b"x-forwarded-for"
+        ]
+        entries = [entry.strip() for entry in ",".join(forwarded).split(",") if entry.strip()]
+        if entries:
+            return entries[-min(TRUSTED_PROXY_HOPS, len(entries))]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+class RateLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+        now = time.monotonic()
+        retry_after = ip_buckets.acquire(client_ip(scope), now)
+        # The user id in the path is not authenticated, so anyone can spend a user's bucket.
+        # Only mutations are keyed per user; reads like GET /api/user/{id} rely on the IP bucket alone.
+        if not retry_after and scope["method"] != "GET":
+            user_id = scope["path"].rstrip("/").rsplit("/", 1)[-1]
+            if user_id.isdigit():
+                retry_after = user_buckets.acquire(user_id, now)
+        if retry_after:
+            response = JSONResponse(
+                {"success": False, "message": "Too many requests"},
+                status_code=429,
+                headers={"Retry-After": str(int(retry_after) + 1)}
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+# Broadcast
+# Progress is saved after every chunk as (shard, last user_id sent), so a restart resends at most one chunk
+broadcast_state: Optional[Dict[str, Any]] = None
+broadcast_task: Optional[asyncio.Task] = None
+broadcast_start_lock = asyncio.Lock()
+broadcast_limiter = TokenBucketTable(BROADCAST_RATE, BROADCAST_RATE)
+broadcast_paused_until = 0.0
+
+async def load_broadcast_state():
+    global broadcast_state
+    try:
+        async with aiofiles.open(BROADCAST_FILE, mode='r') as f:
+            broadcast_state = json.loads(await f.read())
+    except FileNotFoundError:
+        broadcast_state = None
+
+async def save_broadcast_state():
+    await asyncio.to_thread(write_snapshot, BROADCAST_FILE, json.dumps(broadcast_state))
+
+async def acquire_broadcast_slot():
+    while True:
+        now = time.monotonic()
+        # A flood wait from Telegram pauses every sender, not just the one that received it
+        if now < broadcast_paused_until:
+            await asyncio.sleep(broadcast_paused_until - now)
+            continue
+        wait = broadcast_limiter.acquire("global", now)
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+async def set_users_blocked(user_ids: List[int], blocked: bool):
+    touched: Dict[int, Dict[str, Any]] = {}
+    for user_id in user_ids:
+        users = await read_json(user_id)
+        user_id_str = str(user_id)
+        if user_id_str in users and users[user_id_str].get("blocked", False) != blocked:
+            users[user_id_str]["blocked"] = blocked
+            touched[user_id] = users
+    # Commits to the same shard share one group write
+    await asyncio.gather(*(write_json(user_id, users) for user_id, users in touched.items()))
+
+async def send_broadcast_message(bot, user_id: int, text: str) -> str:
+    global broadcast_paused_until
+    from telegram.error import Forbidden, RetryAfter, TelegramError
+
+    for _ in range(3):
+        await acquire_broadcast_slot()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return "sent"
+        except RetryAfter as e:
+            broadcast_paused_until = max(broadcast_paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"Broadcast paused for {e.retry_after}s by Telegram flood control")
+        except Forbidden:
+            return "blocked"
+        except TelegramError as e:
+            logger.error(f"Broadcast to {user_id} failed: {e}")
+            return "failed"
+    return "failed"
+
+async def run_broadcast():
+    state = broadcast_state
+    bot = get_application().bot
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def deliver(user_id: int) -> str:
+        async with semaphore:
+            result = await send_broadcast_message(bot, user_id, state["text"])
+        state[result] += 1
+        return result
+
+    for index in range(state["shard"], USER_SHARDS):
+        users = await users_shards[index].load()
+        user_ids = sorted(int(user_id_str) for user_id_str, user in users.items() if not user.get("blocked"))
+        start = 0 if state["cursor"] is None else bisect.bisect_right(user_ids, state["cursor"])
+        for chunk_start in range(start, len(user_ids), BROADCAST_CHUNK):
+            if state["status"] != "running":
+                await save_broadcast_state()
+                return
+            batch = user_ids[chunk_start:chunk_start + BROADCAST_CHUNK]
+            results = await asyncio.gather(*(deliver(user_id) for user_id in batch))
+            # Users who blocked the bot are marked with one store commit per chunk rather than one each
+            await set_users_blocked([user_id for user_id, result in zip(batch, results) if result == "blocked"], True)
+            state["cursor"] = batch[-1]
+            await save_broadcast_state()
+        state["shard"] = index + 1
+        state["cursor"] = None
+    if state["status"] != "running":
+        # Cancelled during the final chunk
+        await save_broadcast_state()
+        return
+    state["status"] = "done"
+    state["finished_at"] = dt.datetime.now().isoformat()
+    await save_broadcast_state()
+    await bot.send_message(
+        chat_id=ADMIN_CHANNEL_ID,
+        text=f"Broadcast #{state['id']} finished\nSent: {state['sent']}\nBlocked: {state['blocked']}\nFailed: {state['failed']}"
+    )
+
+def new_broadcast_state(text: str) -> Dict[str, Any]:
+    return {
+        "id": (broadcast_state["id"] + 1) if broadcast_state else 1,
+        "text": text,
+        "status": "running",
+        "shard": 0,
+        "cursor": None,
+        "sent": 0,
+        "blocked": 0,
+        "failed": 0,
+        "started_at": dt.datetime.now().isoformat(),
+        "finished_at": None
+    }
+
+async def start_broadcast_job():
+    global broadcast_task
+
+    async def job():
+        try:
+            await run_broadcast()
+        except Exception as e:
+            logger.error(f"Broadcast #{broadcast_state['id']} stopped: {e}")
+
+    broadcast_task = spawn_background(job())
+
+async def resume_broadcast():
+    await load_broadcast_state()
+    if broadcast_state and broadcast_state["status"] == "running":
+        logger.info(f"Resuming broadcast #{broadcast_state['id']} at shard {broadcast_state['shard']}")
+        await start_broadcast_job()
+
+# Profiling
+profile_lock = asyncio.Lock()
+loop_thread_id: Optional[int] = None
+loop_heartbeat = time.monotonic()
+loop_blocks = Counter("event_loop_blocked_total", "Times the event loop was blocked longer than the threshold")
+METRICS.append(loop_blocks)
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> Dict[str, int]:
+    # Runs in a worker thread and only reads the loop thread's frames, so the loop is never paused
+    stacks: Dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+        if labels:
+            stack = ";".join(reversed(labels))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+async def heartbeat():
+    global loop_heartbeat
+    while True:
+        loop_heartbeat = time.monotonic()
+        await asyncio.sleep(LOOP_BLOCK_THRESHOLD / 4)
+
+def watch_loop():
+    reported = None
+    while True:
+        time.sleep(LOOP_BLOCK_THRESHOLD / 4)
+        beat = loop_heartbeat
+        blocked_for = time.monotonic() - beat
+        if blocked_for < LOOP_BLOCK_THRESHOLD or reported == beat:
+            continue
+        # Report each stall once, with the stack that is holding the loop
+        reported = beat
+        loop_blocks.inc()
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "unavailable"
+        logger.warning(f"Event loop blocked for {blocked_for:.3f}s:\n{stack}")
+
+@app.on_event("startup")
+async def start_loop_watchdog():
+    global loop_thread_id
+    loop_thread_id = threading.get_ident()
+    spawn_background(heartbeat())
+    threading.Thread(target=watch_loop, daemon=True).start()
+
 # API endpoints
 @app.get("/api/user/{user_id}")
 async def get_user(user_id: int):
@@ -193,7 +1261,10 @@ async def get_user(user_id: int):
     }
 
 @app.post("/api/watch_ad/{user_id}")
-async def watch_ad(user_id: int):
+async def watch_ad(user_id: int, request: Request):
+    return await run_idempotent(idempotency_key(request, "watch_ad", user_id), lambda: process_watch_ad(user_id))
+
+async def process_watch_ad(user_id: int):
     user = await get_user_data(user_id)
     if not user["channel_verified"]:
         return {"success": False, "message": "Channel membership not verified"}
@@ -228,11 +1299,13 @@ async def watch_ad(user_id: int):
         return {"success": False, "limit_reached": True}
 
     await update_daily_ads(user_id, zone_key, 1)
-    await update_points(user_id, 0.5)
+    await update_points(user_id, AD_REWARD)
 
     invited_by = user.get("invited_by")
+    referral_bonus = 0.0
     if invited_by:
-        await update_points(invited_by, 0.035)
+        referral_bonus = await add_referral_earning(invited_by, REFERRAL_BONUS)
+    record_ad_view(user_id, zone_key, invited_by, referral_bonus)
 
     user = await get_user_data(user_id)
     total_ads_watched = (
@@ -254,6 +1327,9 @@ async def watch_ad(user_id: int):
 @app.post("/api/withdraw/{user_id}")
 async def withdraw(user_id: int, request: Request):
     data = await request.json()
+    return await run_idempotent(idempotency_key(request, "withdraw", user_id), lambda: process_withdraw(user_id, data))
+
+async def process_withdraw(user_id: int, data: Dict[str, Any]):
     amount = float(data["amount"])
     easypaisa_jazzcash = data["easypaisa_jazzcash"]
     if amount < 150 or not easypaisa_jazzcash:
@@ -268,6 +1344,210 @@ async def verify_channel(user_id: int):
         return {"success": True, "message": "Channel membership verified"}
     return {"success": False, "message": "You must join the channel first"}
 
+# Admin endpoints
+def require_admin(request: Request):
+    token = request.headers.get("X-Admin-Token")
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        token = authorization[len("Bearer "):]
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    require_admin(request)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+EXPORT_COLUMNS = [
+    "user_id", "points", "invited_by", "invited_friends", "easypaisa_jazzcash",
+    "channel_verified", "last_ad_date", "created_at"
+]
+
+def user_matches(user: dict, min_points: Optional[float], invited_by: Optional[int]) -> bool:
+    if min_points is not None and user["points"] < min_points:
+        return False
+    if invited_by is not None and user.get("invited_by") != invited_by:
+        return False
+    return True
+
+async def export_users_csv(min_points: Optional[float], invited_by: Optional[int]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for chunk in iter_users():
+        for _, user in chunk:
+            if user_matches(user, min_points, invited_by):
+                writer.writerow([user.get(column) for column in EXPORT_COLUMNS])
+        if buffer.tell():
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10, interval_ms: float = 5):
+    require_admin(request)
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    interval = max(0.001, interval_ms / 1000)
+    async with profile_lock:
+        stacks = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, interval)
+    # Collapsed-stack format, ready for flamegraph.pl or speedscope
+    return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items())))
+
+@app.get("/admin/export/users.csv")
+async def admin_export_users(request: Request, min_points: Optional[float] = None, invited_by: Optional[int] = None):
+    require_admin(request)
+    return StreamingResponse(
+        export_users_csv(min_points, invited_by),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=users.csv"}
+    )
+
+@app.get("/admin/stats")
+async def admin_stats(request: Request, top: int = 10, min_points: Optional[float] = None, invited_by: Optional[int] = None):
+    require_admin(request)
+    top = max(0, min(top, LEADERBOARD_SIZE))
+    today = dt.datetime.now().date().isoformat()
+    users_count = 0
+    verified_count = 0
+    total_liabilities = 0.0
+    ads_today = {zone_key: 0 for zone_key in AD_ZONE_KEYS}
+    async for chunk in iter_users():
+        for _, user in chunk:
+            if not user_matches(user, min_points, invited_by):
+                continue
+            users_count += 1
+            total_liabilities += user["points"]
+            if user["channel_verified"]:
+                verified_count += 1
+            if user["last_ad_date"] == today:
+                for zone_key in AD_ZONE_KEYS:
+                    ads_today[zone_key] += user[f"{zone_key}_daily_ads_watched"]
+    return {
+        "users": users_count,
+        "channel_verified": verified_count,
+        "total_liabilities": round(total_liabilities, 4),
+        "ads_today": ads_today,
+        # Served from the referral index so it matches /admin/referrals/top; not narrowed by the filters
+        "top_referrers": [
+            {"user_id": referrer_id, "invited_friends": int(invited)}
+            for referrer_id, invited in top_inviters.top(top)
+        ]
+    }
+
+@app.get("/admin/withdrawals/pending")
+async def admin_pending_withdrawals(request: Request, limit: int = 100):
+    require_admin(request)
+    pending = list(islice(pending_withdrawals.values(), limit))
+    return {"pending_count": len(pending_withdrawals), "withdrawals": pending}
+
+@app.post("/admin/withdrawals/process")
+async def admin_process_withdrawals(request: Request):
+    require_admin(request)
+    data = await request.json()
+    state = data.get("state", "paid")
+    if state not in WITHDRAWAL_STATES or state == "pending":
+        raise HTTPException(status_code=400, detail="state must be 'paid' or 'rejected'")
+    if "ids" in data:
+        withdrawal_ids = [int(i) for i in data["ids"]]
+    else:
+        withdrawal_ids = list(islice(pending_withdrawals, int(data.get("limit", 100))))
+    batch = await process_withdrawals(state, withdrawal_ids)
+    total = sum(withdrawal["amount"] for withdrawal in batch)
+    if batch:
+        await get_application().bot.send_message(
+            chat_id=ADMIN_CHANNEL_ID,
+            text=f"Payout batch: {len(batch)} withdrawals marked {state}\nTotal: {total} RS\nIDs: {batch[0]['id']}..{batch[-1]['id']}\nStill pending: {len(pending_withdrawals)}"
+        )
+    return {
+        "success": True,
+        "state": state,
+        "processed": [withdrawal["id"] for withdrawal in batch],
+        "skipped": len(withdrawal_ids) - len(batch),
+        "total_amount": total
+    }
+
+@app.get("/admin/reports/ad_views")
+async def admin_ad_view_report(request: Request, start: Optional[str] = None, end: Optional[str] = None):
+    require_admin(request)
+    rollup = await run_ad_rollup()
+    days = {
+        day: zones for day, zones in sorted(rollup["days"].items())
+        if (start is None or day >= start) and (end is None or day <= end)
+    }
+    totals = {"views": 0, "rewards": 0.0, "referral_bonuses": 0.0}
+    for zones in days.values():
+        for zone_totals in zones.values():
+            for key in totals:
+                totals[key] += zone_totals[key]
+    return {"days": days, "totals": totals}
+
+@app.get("/admin/broadcast")
+async def admin_broadcast_status(request: Request):
+    require_admin(request)
+    return {"broadcast": broadcast_state}
+
+@app.post("/admin/broadcast")
+async def admin_start_broadcast(request: Request):
+    global broadcast_state
+    require_admin(request)
+    data = await request.json()
+    text = (data.get("text") or "").strip()
+    if not text:
+        raise HTTPException(status_code=400, detail="text required")
+    async with broadcast_start_lock:
+        if broadcast_state and broadcast_state["status"] == "running":
+            raise HTTPException(status_code=409, detail="A broadcast is already running")
+        if broadcast_task is not None and not broadcast_task.done():
+            # A cancelled job still finishes its current chunk and saves progress; don't race its writes
+            await asyncio.shield(broadcast_task)
+        broadcast_state = new_broadcast_state(text)
+        await save_broadcast_state()
+        await start_broadcast_job()
+    return {"success": True, "broadcast": broadcast_state}
+
+@app.post("/admin/broadcast/cancel")
+async def admin_cancel_broadcast(request: Request):
+    require_admin(request)
+    if not broadcast_state or broadcast_state["status"] != "running":
+        raise HTTPException(status_code=409, detail="No broadcast is running")
+    # The job notices at its next chunk boundary and saves its progress
+    broadcast_state["status"] = "cancelled"
+    return {"success": True, "broadcast": broadcast_state}
+
+@app.get("/admin/referrals/top")
+async def admin_top_referrers(request: Request, by: str = "invited", k: int = 10):
+    require_admin(request)
+    if by not in ("invited", "earnings"):
+        raise HTTPException(status_code=400, detail="by must be 'invited' or 'earnings'")
+    leaderboard = top_inviters if by == "invited" else top_earners
+    return {
+        "by": by,
+        "top": [
+            {
+                "user_id": referrer_id,
+                "invited": len(referral_children.get(referrer_id, ())),
+                "referral_earnings": round(referral_earnings.get(referrer_id, 0.0), 4)
+            }
+            for referrer_id, _ in leaderboard.top(max(0, min(k, LEADERBOARD_SIZE)))
+        ]
+    }
+
+@app.get("/admin/referrals/{user_id}")
+async def admin_referral_network(user_id: int, request: Request, depth: int = 3):
+    require_admin(request)
+    levels = referral_levels(user_id, max(1, min(depth, 10)))
+    return {
+        "user_id": user_id,
+        "invited": len(referral_children.get(user_id, ())),
+        "referral_earnings": round(referral_earnings.get(user_id, 0.0), 4),
+        "levels": levels,
+        "network_size": sum(levels)
+    }
+
 # Mini App HTML
 @app.get("/app")
 async def mini_app():
@@ -657,6 +1937,13 @@ async def mini_app():
         const MONETAG_ZONE2 = "{MONETAG_ZONE2}";
         const MONETAG_ZONE3 = "{MONETAG_ZONE3}";
 
+        function newIdempotencyKey() {
+            if (window.crypto && crypto.randomUUID) {
+                return crypto.randomUUID();
+            }
+            return Date.now().toString(36) + Math.random().toString(36).slice(2);
+        }
+
         function getCachedVerificationStatus() {
             return localStorage.getItem(`channel_verified_${userId}`) === 'true';
         }
@@ -796,7 +2083,10 @@ async def mini_app():
                 }
 
                 await window[`show_${zone}`]();
-                const response = await fetch('/api/watch_ad/' + userId, { method: 'POST' });
+                const response = await fetch('/api/watch_ad/' + userId, {
+                    method: 'POST',
+                    headers: {'Idempotency-Key': newIdempotencyKey()}
+                });
                 const data = await response.json();
                 if (data.success) {
                     tg.showAlert('Ad watched! +0.5 RS');
@@ -837,7 +2127,7 @@ async def mini_app():
             }
             const response = await fetch('/api/withdraw/' + userId, {
                 method: 'POST',
-                headers: {'Content-Type': 'application/json'},
+                headers: {'Content-Type': 'application/json', 'Idempotency-Key': newIdempotencyKey()},
                 body: JSON.stringify({amount, easypaisa_jazzcash: easypaisaJazzcash})
             });
             const data = await response.json();
@@ -874,9 +2164,16 @@ async def mini_app():
 # Telegram webhook
 @app.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
+    from telegram import Update
+
     update_json = await request.json()
+    application = get_application()
     update = Update.de_json(update_json, application.bot)
-    await application.process_update(update)
+    webhook_in_flight.inc()
+    try:
+        await application.process_update(update)
+    finally:
+        webhook_in_flight.dec()
     return {"ok": True}
 
 @app.get("/set-webhook")
@@ -885,15 +2182,26 @@ async def set_webhook():
         raise HTTPException(status_code=400, detail="BASE_URL not set")
     webhook_url = f"{BASE_URL}/telegram/webhook"
     try:
-        await application.bot.set_webhook(webhook_url)
+        await get_application().bot.set_webhook(webhook_url)
         return {"status": "set", "url": webhook_url}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Bot handlers
-application = Application.builder().token(BOT_TOKEN).build()
+application: Optional[Application] = None
+
+def get_application() -> Application:
+    global application
+    if application is None:
+        from telegram.ext import Application, CommandHandler
+
+        application = Application.builder().token(BOT_TOKEN).base_url(f"{TELEGRAM_API_URL}/bot").request(instrumented_request()).build()
+        application.add_handler(CommandHandler("start", start))
+    return application
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
     args = context.args
     invited_by = None
     if args and args[0].startswith("ref"):
@@ -903,6 +2211,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             invited_by = None
     
     user, is_new = await get_or_create_user(update.effective_user.id, invited_by)
+    if user.get("blocked"):
+        # Sending /start again means the user unblocked the bot
+        await set_users_blocked([update.effective_user.id], False)
     
     if is_new and invited_by and invited_by != update.effective_user.id:
         await add_invited_friend(invited_by)
@@ -914,54 +2225,96 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(welcome_text, reply_markup=reply_markup)
 
-application.add_handler(CommandHandler("start", start))
-
 # SELF-PINGING TASK
 PING_INTERVAL = 240
 
-def start_ping_task():
-    async def ping_self():
+async def ping_self():
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
         while True:
+            await asyncio.sleep(PING_INTERVAL)
+            if not BASE_URL:
+                continue
             try:
-                if not BASE_URL:
-                    await asyncio.sleep(PING_INTERVAL)
-                    continue
-                response = requests.get(f"{BASE_URL}/", timeout=10)
-                response.raise_for_status()
-            except Exception as e:
+                async with session.get(f"{BASE_URL}/healthz") as resp:
+                    resp.raise_for_status()
+            except Exception:
                 pass
-            await asyncio.sleep(PING_INTERVAL)
-
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(ping_self())
-
-threading.Thread(target=start_ping_task, daemon=True).start()
 
 # Initialize
+@app.on_event("startup")
+async def start_initialization():
+    spawn_background(initialize_app())
+    spawn_background(ping_self())
+    spawn_background(flush_ad_events_periodically())
+    spawn_background(roll_up_ad_events_periodically())
+
 async def initialize_app():
-    await validate_token()
-    await init_json()
-    await application.initialize()
+    started = time.perf_counter()
+    await asyncio.gather(init_store(), init_bot())
+    logger.info(f"Startup completed in {time.perf_counter() - started:.2f}s")
+    await resume_broadcast()
+
+async def init_store():
+    try:
+        await init_json()
+        await asyncio.gather(build_referral_index(), load_withdrawal_ledger())
+        await reconcile_withdrawals()
+    except Exception as e:
+        # Nothing can be served without the store; exit so the platform restarts the dyno
+        logger.critical(f"Store failed to load, exiting: {e}")
+        logging.shutdown()
+        os._exit(1)
+    store_ready.set()
+
+async def retry_with_backoff(name: str, step):
+    global startup_error
+    delay = 1
+    while True:
+        try:
+            await step()
+            startup_error = None
+            return
+        except Exception as e:
+            startup_error = f"{name}: {e}"
+            logger.error(f"{name} failed, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BOT_INIT_MAX_BACKOFF)
+
+async def init_bot():
+    # The telegram package is slow to import, so load it off the event loop
+    await asyncio.to_thread(import_module, "telegram.ext")
+    application = get_application()
+    await retry_with_backoff("Bot initialization", lambda: connect_bot(application))
+    bot_ready.set()
     if BASE_URL:
-        webhook_url = f"{BASE_URL}/telegram/webhook"
-        await application.bot.set_webhook(webhook_url)
+        # Runs on its own so a webhook that keeps failing doesn't hold back the rest of startup
+        spawn_background(retry_with_backoff("Webhook setup", lambda: ensure_webhook(application)))
+
+async def connect_bot(application: Application):
+    # Wait for both calls even if one fails, so a retry never overlaps a still-running initialize()
+    results = await asyncio.gather(validate_token(), application.initialize(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+async def ensure_webhook(application: Application):
+    webhook_url = f"{BASE_URL}/telegram/webhook"
+    info = await application.bot.get_webhook_info()
+    if info.url == webhook_url:
+        logger.info("Webhook already set")
+        return
+    await application.bot.set_webhook(webhook_url)
 
 async def validate_token():
     if not BOT_TOKEN:
         raise ValueError("BOT_TOKEN not set")
     async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe") as resp:
-            if resp.status != 200:
-                raise ValueError(f"Invalid BOT_TOKEN: {await resp.text()}")
+        async with observe_telegram("getMe"):
+            async with session.get(f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getMe") as resp:
+                if resp.status != 200:
+                    raise ValueError(f"Invalid BOT_TOKEN: {await resp.text()}")
 
 if __name__ == "__main__":
     if not BOT_TOKEN:
         raise RuntimeError("Missing BOT_TOKEN")
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(initialize_app())
-        uvicorn.run(app, host="0.0.0.0", port=PORT, workers=1)
-    finally:
-        loop.close()
+    uvicorn.run(app, host="0.0.0.0", port=PORT, workers=1)